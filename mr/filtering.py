@@ -21,7 +21,7 @@ def filter_stubs(tracks, threshold=100):
         tracks['probe']
     except KeyError:
         raise ValueError, "Tracks must contain columns 'frame' and 'probe'."
-    grouped = tracks.reset_index(drop=True).groupby('probe')
+    grouped = tracks.reset_index(drop=True).groupby('probe', sort=False)
     filtered = grouped.filter(lambda x: x.frame.count() >= threshold)
     return filtered.set_index('frame', drop=False)
 
@@ -50,7 +50,7 @@ def filter_clusters(tracks, quantile=0.8, threshold=None):
         threshold = tracks['size'].quantile(quantile)
 
     f = lambda x: x['size'].mean() < threshold # filtering function
-    grouped = tracks.reset_index(drop=True).groupby('probe')
+    grouped = tracks.reset_index(drop=True).groupby('probe', sort=False)
     filtered = grouped.filter(f)
     return filtered.set_index('frame', drop=False)
 
@@ -71,7 +71,7 @@ def filter(tracks, condition_func):
     DataFrame
         a subset of tracks
     """
-    grouped = tracks.reset_index(drop=True).groupby('probe')
+    grouped = tracks.reset_index(drop=True).groupby('probe', sort=False)
     filtered = grouped.filter(condition_func)
     return filtered.set_index('frame', drop=False)
 
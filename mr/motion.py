@@ -26,6 +26,93 @@ from scipy.spatial import cKDTree
 
 logger = logging.getLogger(__name__)
 
+try:
+    import bottleneck as bn
+except ImportError:
+    bn = None
+
+try:
+    from numba import njit, prange
+except ImportError:
+    def _msd_kernel(frame, pos, max_lagtime, out_sx, out_sy, out_sxx,
+                    out_syy, out_n):
+        """Fill per-lagtime sums of displacements, squared displacements,
+        and counts of valid displacements from sorted frame numbers and an
+        array of x, y. Frames missing from the trajectory are skipped."""
+        F = len(frame)
+        for i in range(max_lagtime):
+            lt = i + 1
+            # Find the row, if any, lt frames after each row.
+            later = np.searchsorted(frame, frame + lt)
+            found = later < F
+            found[found] = frame[later[found]] == frame[found] + lt
+            d = pos[later[found]] - pos[found]
+            d = d[np.isfinite(d).all(1)]
+            out_sx[i], out_sy[i] = d.sum(0)
+            out_sxx[i], out_syy[i] = (d**2).sum(0)
+            out_n[i] = len(d)
+
+    def _msd_segments(frame, pos, bounds, max_lagtime, out):
+        """Fill out[:, p] with the sums of _msd_kernel for each probe p,
+        whose rows in frame and pos span bounds[p]:bounds[p + 1]."""
+        for p in range(len(bounds) - 1):
+            start, stop = bounds[p], bounds[p + 1]
+            L = min(max_lagtime, stop - start) - 1
+            _msd_kernel(frame[start:stop], pos[start:stop], L, out[0, p],
+                        out[1, p], out[2, p], out[3, p], out[4, p])
+else:
+    # No 'nnan' in fastmath: the kernel relies on NaN comparisons to skip
+    # missing positions.
+    @njit(cache=True, fastmath={'reassoc', 'contract', 'arcp'},
+          boundscheck=False)
+    def _msd_kernel(frame, pos, max_lagtime, out_sx, out_sy, out_sxx,
+                    out_syy, out_n):
+        """Fill per-lagtime sums of displacements, squared displacements,
+        and counts of valid displacements from sorted frame numbers and an
+        array of x, y. Frames missing from the trajectory are skipped."""
+        F = frame.shape[0]
+        for i in range(max_lagtime):
+            lt = i + 1
+            sx = 0.0
+            sy = 0.0
+            sxx = 0.0
+            syy = 0.0
+            n = 0
+            # Walk a second pointer to the row lt frames after row j.
+            k = 0
+            for j in range(F):
+                target = frame[j] + lt
+                while k < F and frame[k] < target:
+                    k += 1
+                if k == F:
+                    break
+                if frame[k] != target:
+                    continue
+                dx = pos[k, 0] - pos[j, 0]
+                dy = pos[k, 1] - pos[j, 1]
+                if dx == dx and dy == dy:
+                    sx += dx
+                    sy += dy
+                    sxx += dx*dx
+                    syy += dy*dy
+                    n += 1
+            out_sx[i] = sx
+            out_sy[i] = sy
+            out_sxx[i] = sxx
+            out_syy[i] = syy
+            out_n[i] = n
+
+    @njit(cache=True, parallel=True, nogil=True)
+    def _msd_segments(frame, pos, bounds, max_lagtime, out):
+        """Fill out[:, p] with the sums of _msd_kernel for each probe p,
+        whose rows in frame and pos span bounds[p]:bounds[p + 1]."""
+        # Probes are independent, and each writes only its own out[:, p].
+        for p in prange(len(bounds) - 1):
+            start, stop = bounds[p], bounds[p + 1]
+            L = min(max_lagtime, stop - start) - 1
+            _msd_kernel(frame[start:stop], pos[start:stop], L, out[0, p],
+                        out[1, p], out[2, p], out[3, p], out[4, p])
+
 def msd(traj, mpp, fps, max_lagtime=100, detail=False):
     """Compute the mean displacement and mean squared displacement of one 
     trajectory over a range of time intervals.
@@ -55,24 +142,56 @@ def msd(traj, mpp, fps, max_lagtime=100, detail=False):
     --------
     imsd() and emsd()
     """
-    pos = traj.set_index('frame')[['x', 'y']]
-    t = traj['frame']
-    # Reindex with consecutive frames, placing NaNs in the gaps. 
-    pos = pos.reindex(np.arange(pos.index[0], 1 + pos.index[-1]))
-    max_lagtime = min(max_lagtime, len(t)) # checking to be safe
+    frame = traj['frame'].values.astype('float64')
+    order = np.argsort(frame, kind='mergesort')
+    frame = frame[order]
+    pos = np.ascontiguousarray(traj[['x', 'y']].values[order],
+                               dtype='float64')
+    max_lagtime = min(max_lagtime, len(frame)) # checking to be safe
     lagtimes = 1 + np.arange(max_lagtime) 
-    disp = pd.concat([pos.sub(pos.shift(lt)) for lt in lagtimes],
-                     keys=lagtimes, names=['lagt', 'frames'])
-    results = mpp*disp.mean(level=0)
-    results.columns = ['<x>', '<y>']
-    results[['<x^2>', '<y^2>']] = mpp**2*(disp**2).mean(level=0)
-    results['msd'] = mpp**2*(disp**2).mean(level=0).sum(1) # <r^2>
+    # Accumulate sums of displacements for each lagtime directly from the
+    # arrays, rather than building one shifted DataFrame per lagtime.
+    # Gaps in the frame numbers need no filling: displacements across
+    # missing frames are simply not found.
+    sx, sy, sxx, syy = [np.zeros(max_lagtime) for _ in range(4)]
+    n = np.zeros(max_lagtime, dtype=np.int64)
+    _msd_kernel(frame, pos, max_lagtime, sx, sy, sxx, syy, n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        results = DataFrame({'<x>': mpp*sx/n, '<y>': mpp*sy/n,
+                             '<x^2>': mpp**2*sxx/n, '<y^2>': mpp**2*syy/n},
+                            index=pd.Index(lagtimes, name='lagt'),
+                            columns=['<x>', '<y>', '<x^2>', '<y^2>'])
+    results['msd'] = results['<x^2>'] + results['<y^2>'] # <r^2>
     # Estimated statistically independent measurements = 2N/t
     if detail:
-        results['N'] = 2*disp.icol(0).count(level=0).div(Series(lagtimes))
+        results['N'] = 2*n/lagtimes
     results['lagt'] = results.index.values/fps
     return results[:-1]
 
+def _msd_batch(traj, max_lagtime):
+    """Compute the sums underlying msd() for every probe in one pass.
+
+    Returns
+    -------
+    probes : sorted array of probe ids
+    sums : array of shape (5, len(probes), L) holding the sums of x, y, x^2,
+        y^2 displacements and the number of displacements, by probe and
+        lagtime. Lagtimes beyond a probe's range, as msd() reports it,
+        are left at zero.
+    """
+    probe = traj['probe'].values
+    frame = traj['frame'].values.astype('float64')
+    order = np.lexsort((frame, probe))
+    probe, frame = probe[order], frame[order]
+    pos = np.ascontiguousarray(traj[['x', 'y']].values[order],
+                               dtype='float64')
+    probes, starts = np.unique(probe, return_index=True)
+    bounds = np.append(starts, len(probe)).astype(np.int64)
+    L = max(0, min(max_lagtime, np.diff(bounds).max()) - 1)
+    sums = np.zeros((5, len(probes), L))
+    _msd_segments(frame, pos, bounds, L + 1, sums)
+    return probes, sums
+
 def imsd(traj, mpp, fps, max_lagtime=100, statistic='msd'):
     """Compute the mean squared displacements of probes individually.
     
@@ -96,18 +215,14 @@ def imsd(traj, mpp, fps, max_lagtime=100, statistic='msd'):
     -----
     Input units are pixels and frames. Output units are microns and seconds.
     """
-    ids = []
-    msds = []
-    # Note: Index is set by msd, so we don't need to worry
-    # about conformity here.
-    for pid, ptraj in traj.groupby('probe'):
-        msds.append(msd(ptraj, mpp, fps, max_lagtime, False))
-        ids.append(pid)
-    results = pd.concat(msds, keys=ids)
-    # Swap MultiIndex levels so that unstack() makes probes into columns.
-    results = results.swaplevel(0, 1)[statistic].unstack()
-    lagt = results.index.values.astype('float64')/float(fps)
-    results.set_index(lagt, inplace=True)
+    probes, sums = _msd_batch(traj, max_lagtime)
+    sx, sy, sxx, syy, n = sums
+    with np.errstate(divide='ignore', invalid='ignore'):
+        statistics = {'<x>': mpp*sx/n, '<y>': mpp*sy/n,
+                      '<x^2>': mpp**2*sxx/n, '<y^2>': mpp**2*syy/n,
+                      'msd': mpp**2*(sxx + syy)/n}
+    lagt = (1 + np.arange(sums.shape[2])).astype('float64')/float(fps)
+    results = DataFrame(statistics[statistic].T, index=lagt, columns=probes)
     results.index.name = 'lag time [s]'
     return results
 
@@ -134,16 +249,20 @@ def emsd(traj, mpp, fps, max_lagtime=100, detail=False):
     -----
     Input units are pixels and frames. Output units are microns and seconds.
     """
-    ids = []
-    msds = []
-    for pid, ptraj in traj.reset_index(drop=True).groupby('probe'):
-        msds.append(msd(ptraj, mpp, fps, max_lagtime, True))
-        ids.append(pid)
-    msds = pd.concat(msds, keys=ids, names=['probe', 'frame'])
-    results = msds.mul(msds['N'], axis=0).mean(level=1) # weighted average
-    results = results.div(msds['N'].mean(level=1), axis=0) # weights normalized
-    # Above, lagt is lumped in with the rest for simplicity and speed.
-    # Here, rebuild it from the frame index.
+    probes, sums = _msd_batch(traj, max_lagtime)
+    # Weighting each probe's averages by N = 2n/t amounts to pooling the
+    # sums of all the probes at each lagtime.
+    sx, sy, sxx, syy, n = sums.sum(1)
+    lagtimes = 1 + np.arange(sums.shape[2])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        results = DataFrame({'<x>': mpp*sx/n, '<y>': mpp*sy/n,
+                             '<x^2>': mpp**2*sxx/n, '<y^2>': mpp**2*syy/n},
+                            index=pd.Index(lagtimes, name='frame'),
+                            columns=['<x>', '<y>', '<x^2>', '<y^2>'])
+        results['msd'] = results['<x^2>'] + results['<y^2>']
+        # Weighted average of N itself
+        results['N'] = 2*(sums[4]**2).sum(0)/n/lagtimes
+    results['lagt'] = lagtimes/fps
     if not detail:
         return results.set_index('lagt')['msd']
     return results
@@ -171,18 +290,28 @@ def compute_drift(traj, smoothing=0):
     drift = compute_drift(traj, 15) # Save good drift curves.
     corrected_traj = subtract_drift(traj, drift) # Apply them.
     """
-    # Probe by probe, take the difference between frames.
-    delta = pd.concat([t.set_index('frame', drop=False).diff()
-                       for p, t in traj.groupby('probe')])
-    # Keep only deltas between frames that are consecutive. 
-    delta = delta[delta['frame'] == 1]
-    # Restore the original frame column (replacing delta frame).
-    del delta['frame']
-    delta.reset_index(inplace=True)
-    dx = delta.groupby('frame').mean()
+    # Sort by probe, then frame, and take the difference between rows.
+    probe = traj['probe'].values
+    frame = traj['frame'].values
+    order = np.lexsort((frame, probe))
+    probe, frame = probe[order], frame[order]
+    delta = np.diff(traj[['x', 'y']].values[order].astype('float64'), axis=0)
+    # Keep only deltas between consecutive frames of the same probe.
+    valid = (np.diff(probe) == 0) & (np.diff(frame) == 1)
+    delta = delta[valid]
+    frames, inverse = np.unique(frame[1:][valid], return_inverse=True)
+    counts = np.bincount(inverse)
+    dx = DataFrame({'x': np.bincount(inverse, delta[:, 0])/counts,
+                    'y': np.bincount(inverse, delta[:, 1])/counts},
+                   index=pd.Index(frames, name='frame'), columns=['x', 'y'])
     if smoothing > 0:
-        dx = pd.rolling_mean(dx, smoothing, min_periods=0)
-    x = dx.cumsum(0)[['x', 'y']]
+        if bn is not None:
+            dx = DataFrame(bn.move_mean(dx.values, smoothing, min_count=1,
+                                        axis=0),
+                           index=dx.index, columns=dx.columns)
+        else:
+            dx = pd.rolling_mean(dx, smoothing, min_periods=0)
+    x = dx.cumsum(0)
     return x
 
 def subtract_drift(traj, drift=None):
@@ -201,7 +330,12 @@ def subtract_drift(traj, drift=None):
 
     if drift is None: 
         drift = compute_drift(traj)
-    return traj.set_index('frame', drop=False).sub(drift, fill_value=0)
+    traj = traj.set_index('frame', drop=False)
+    # Align the drift with each row's frame, taking no drift where none
+    # was measured, and touch only the position columns.
+    drift = drift[['x', 'y']].reindex(traj['frame'].values, fill_value=0)
+    traj[['x', 'y']] = traj[['x', 'y']].values - drift.values
+    return traj
 
 def is_typical(msds, frame=23, lower=0.1, upper=0.9):
     """Examine individual probe MSDs, distinguishing outliers from those
@@ -268,14 +402,21 @@ def vanhove(pos, lagtime=23, mpp=1, ensemble=False, bins=24):
     assert lagtime <= pos.index.values.max(), \
         "There is a no data out to frame %s. " % frame
     disp = mpp*pos.sub(pos.shift(lagtime))
+    arr = disp.values
+    finite = np.isfinite(arr)
     # Let np.histogram choose the best bins for all the data together.
-    values = disp.values.flatten()
-    values = values[np.isfinite(values)]
-    global_bins = np.histogram(values, bins=bins)[1]
-    # Use those bins to histogram each column by itself. 
-    vh = disp.apply(
-        lambda x: Series(np.histogram(x, bins=global_bins, density=True)[0])) 
-    vh.index = global_bins[:-1]
+    global_bins = np.histogram(arr[finite], bins=bins)[1]
+    # Use those bins to histogram each column by itself, all at once.
+    nbins, ncols = len(global_bins) - 1, arr.shape[1]
+    idx = np.searchsorted(global_bins, arr, side='right') - 1
+    idx[arr == global_bins[-1]] = nbins - 1  # last bin includes right edge
+    col = np.tile(np.arange(ncols), (arr.shape[0], 1))
+    valid = finite & (idx >= 0) & (idx < nbins)
+    counts = np.bincount(idx[valid]*ncols + col[valid],
+                         minlength=nbins*ncols).reshape(nbins, ncols)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        density = counts/(counts.sum(0)*np.diff(global_bins)[:, np.newaxis])
+    vh = DataFrame(density, index=global_bins[:-1], columns=disp.columns)
     if ensemble:
         return vh.sum(1)/len(vh.columns)
     else:
@@ -313,10 +454,13 @@ def is_diffusive(traj, threshold=0.9):
     raise NotImplementedError, "I will rewrite this."
 
 def relate_frames(t, frame1, frame2):
-    a = t[t.frame == frame1]
-    b = t[t.frame == frame2]
-    j = a.set_index('probe')[['x', 'y']].join(
-         b.set_index('probe')[['x', 'y']], rsuffix='_b')
+    frame = t['frame'].values
+    columns = ['probe', 'x', 'y']
+    a = t.loc[frame == frame1, columns]
+    b = t.loc[frame == frame2, columns]
+    # A single hash join on probe, keeping every probe in frame1.
+    j = a.merge(b, on='probe', how='left', suffixes=('', '_b'))
+    j.set_index('probe', inplace=True)
     j['dx'] = j.x_b - j.x
     j['dy'] = j.y_b - j.y
     j['dr'] = np.sqrt(j['dx']**2 + j['dy']**2)
@@ -337,12 +481,12 @@ def direction_corr(t, frame1, frame2):
     DataFrame, indexed by probe, including dx, dy, and direction
     """
     j = relate_frames(t, frame1, frame2)
-    cosine = np.cos(np.subtract.outer(j.direction, j.direction))
-    r = np.sqrt(np.subtract.outer(j.x, j.x)**2 +
-                np.subtract.outer(j.y, j.y)**2)
-    upper_triangle = np.triu_indices_from(r, 1)
-    result = DataFrame({'r': r[upper_triangle],
-                        'cos': cosine[upper_triangle]})
+    # Compute only the pairs in the upper triangle.
+    i, k = np.triu_indices(len(j), 1)
+    x, y, direction = j.x.values, j.y.values, j.direction.values
+    r = np.hypot(x[i] - x[k], y[i] - y[k])
+    cosine = np.cos(direction[i] - direction[k])
+    result = DataFrame({'r': r, 'cos': cosine})
     return result 
 
 def velocity_corr(t, frame1, frame2):
@@ -360,13 +504,14 @@ def velocity_corr(t, frame1, frame2):
     DataFrame, indexed by probe, including dx, dy, and direction
     """
     j = relate_frames(t, frame1, frame2)
-    cosine = np.cos(np.subtract.outer(j.direction, j.direction))
-    r = np.sqrt(np.subtract.outer(j.x, j.x)**2 +
-                np.subtract.outer(j.y, j.y)**2)
-    dot_product = cosine*np.abs(np.multiply.outer(j.dr, j.dr))
-    upper_triangle = np.triu_indices_from(r, 1)
-    result = DataFrame({'r': r[upper_triangle],
-                        'dot_product': dot_product[upper_triangle]})
+    # Compute only the pairs in the upper triangle.
+    i, k = np.triu_indices(len(j), 1)
+    x, y = j.x.values, j.y.values
+    direction, dr = j.direction.values, j.dr.values
+    r = np.hypot(x[i] - x[k], y[i] - y[k])
+    cosine = np.cos(direction[i] - direction[k])
+    dot_product = cosine*np.abs(dr[i]*dr[k])
+    result = DataFrame({'r': r, 'dot_product': dot_product})
     return result 
 
 def theta_entropy(pos, bins=24, plot=True):
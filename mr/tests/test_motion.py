@@ -146,6 +146,21 @@ class TestMSD(unittest.TestCase):
         actual.index = expected.index
         assert_series_equal(np.round(actual), expected)
 
+    def test_msd_with_gaps(self):
+        # A steady stepper is displaced by the lag time, even across gaps.
+        N = 10
+        traj = DataFrame({'x': np.arange(N), 'y': np.zeros(N),
+                          'frame': np.arange(N), 'probe': np.zeros(N)})
+        traj = conformity(traj.drop([3, 4]))
+        actual = mr.msd(traj, 1, 1)
+        lagt = np.arange(1, N - 2, dtype='float64')
+        assert_almost_equal(actual.index.values, lagt)
+        assert_almost_equal(actual['msd'].values, lagt**2)
+        assert_almost_equal(actual['<x>'].values, lagt)
+
+        actual = mr.imsd(traj, 1, 1)
+        assert_almost_equal(actual[0].values, lagt**2)
+
 class TestSpecial(unittest.TestCase):
     
     def setUp(self):